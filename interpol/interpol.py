@@ -1,6 +1,8 @@
-import numpy as np, time
+import numpy as np, time, operator
 from enlib import utils
 import fortran_32, fortran_64
+try: import numba
+except ImportError: numba = None
 
 def build(func, interpolator, box, errlim, maxsize=None, maxtime=None, return_obox=False, return_status=False, verbose=False, nstart=None, *args, **kwargs):
 	"""Given a function func([nin,...]) => [nout,...] and
@@ -9,7 +11,14 @@ def build(func, interpolator, box, errlim, maxsize=None, maxtime=None, return_ob
 	which provides __call__([nin,...]) => [nout,...],
 	automatically polls func and constructs an interpolator
 	object that has the required accuracy inside the provided
-	bounding box."""
+	bounding box.
+
+	The grid starts with nstart (default 3) points along each axis.
+	Each refinement step takes an axis from n to 2n-1 points (3, 5, 9,
+	17, ...), halving its spacing so that the old points can be reused.
+	Before this was n to 2n+1 (3, 7, 15, 31, ...), so the grid now grows
+	in smaller steps, and maxsize and maxtime are reached at different
+	grid sizes than before."""
 	box     = np.asfarray(box)
 	errlim  = np.asfarray(errlim)
 	idim    = box.shape[1]
@@ -20,18 +29,26 @@ def build(func, interpolator, box, errlim, maxsize=None, maxtime=None, return_ob
 
 	t0      = time.time()
 
-	# Set up initial interpolation
-	ip = interpolator(box, func(x), *args, **kwargs)
+	# Set up initial interpolation. y holds the function values on the
+	# current grid, so they can be reused when the grid is refined.
+	y  = func(x)
+	ip = interpolator(box, y, *args, **kwargs)
 
 	errs = [np.inf]*idim # Max error for each *input* dimension in last refinement step
 	err  = np.max(errs)
 	depth = 0
+	# max_error stops early once a refinement is needed, so err and errs
+	# can be lower bounds. That's enough to decide what to refine, but when
+	# we give up, the error we report is recomputed in full.
+	ytrue, yinter = None, None
+	def final_err():
+		return err if yinter is None else max_error(ytrue, yinter, np.inf)
 	# Refine until good enough
 	while True:
 		depth += 1
-		if maxsize and np.product(n) > maxsize:
+		if maxsize and prod(n) > maxsize:
 			if return_status:
-				return ip if not return_obox else ip, np.array(obox), False, err
+				return ip if not return_obox else ip, np.array(obox), False, final_err()
 			raise OverflowError("Maximum refinement mesh size exceeded")
 		nok = 0
 		# Consider accuracy for each input parameter by tentatively doubling
@@ -41,23 +58,32 @@ def build(func, interpolator, box, errlim, maxsize=None, maxtime=None, return_ob
 			if any(errs[i] > errlim):
 				if maxtime and time.time() - t0 > maxtime:
 					if return_status:
-						return ip if not return_obox else ip, np.array(obox), False, err
+						return ip if not return_obox else ip, np.array(obox), False, final_err()
 					raise OverflowError("Maximum refinement time exceeded")
 				# Grid may not be good enough in this direction.
-				# Try doubling resolution
+				# Try doubling resolution. Going from n to 2n-1 points halves
+				# the grid spacing, so every even point along this axis is
+				# an old point, and we only need to evaluate func on the odd ones.
 				nnew   = n.copy()
-				nnew[i]= nnew[i]*2+1
+				nnew[i]= nnew[i]*2-1
 				x      = utils.grid(box, nnew)
 				yinter = ip(x)
-				ytrue  = func(x)
+				sold   = (Ellipsis,)+(slice(None),)*i+(slice(0,None,2),)+(slice(None),)*(idim-i-1)
+				snew   = (Ellipsis,)+(slice(None),)*i+(slice(1,None,2),)+(slice(None),)*(idim-i-1)
+				ynew   = func(x[snew])
+				ytrue  = np.empty(ynew.shape[:-idim]+tuple(nnew), np.result_type(y, ynew))
+				ytrue[sold] = y
+				ytrue[snew] = ynew
 				if np.any(np.isnan(ytrue)):
 					raise ValueError("Function to interpolate returned invalid value")
-				err = np.max(np.abs((ytrue-yinter).reshape(ytrue.shape[0],-1)), 1)
+				err = max_error(ytrue, yinter, np.inf if verbose else errlim)
 				if verbose: print x.shape, x.size, err/errlim
 				if any(err > errlim):
-					# Not good enough, so accept improvement
-					ip = interpolator(box, ytrue, *args, **kwargs)
-					n  = nnew
+					# Not good enough, so accept improvement. Interpolators
+					# that support it can reuse work from the coarser grid.
+					if hasattr(ip, "refine"): ip.refine(i, ytrue)
+					else: ip = interpolator(box, ytrue, *args, **kwargs)
+					n, y = nnew, ytrue
 				else: nok += 1
 				errs[i] = err
 				# update output box
@@ -70,14 +96,38 @@ def build(func, interpolator, box, errlim, maxsize=None, maxtime=None, return_ob
 	if return_status: res = res + (True,err)
 	return res[0] if len(res) == 1 else res
 
+def max_error(a, b, errlim, nchunk=16):
+	"""Return the maximum absolute difference between a[nout,...] and
+	b[nout,...] for each output. This is computed in chunks, and stops as
+	soon as some output exceeds errlim, in which case it is only a lower
+	bound."""
+	a, b = a.reshape(a.shape[0],-1), b.reshape(b.shape[0],-1)
+	err  = np.zeros(a.shape[0])
+	step = max(1, -(-a.shape[1]//nchunk))
+	for i in range(0, a.shape[1], step):
+		err = np.maximum(err, np.max(np.abs(a[:,i:i+step]-b[:,i:i+step]),1))
+		if np.any(err > errlim): break
+	return err
+
 class Interpolator:
 	def __init__(self, box, y, *args, **kwargs):
-		self.box, self.y = np.array(box), np.array(y)
+		self.box, self.y = np.asfarray(box), np.array(y)
 		self.args, self.kwargs = args, kwargs
+	def refine(self, axis, y):
+		"""Update the interpolator to use the samples y, which have been
+		refined along the given axis from n to 2n-1 samples, such that
+		the even samples along that axis are the old ones. By default
+		this simply rebuilds the interpolator."""
+		self.__init__(self.box, y, *self.args, **self.kwargs)
 
 class ip_ndimage(Interpolator):
+	def __init__(self, box, y, *args, **kwargs):
+		Interpolator.__init__(self, box, y, *args, **kwargs)
+		# Precompute the mapping from coordinates to pixels
+		self.lo    = self.box[0]
+		self.scale = (np.array(self.y.shape[1:])-1)/(self.box[1]-self.box[0])
 	def __call__(self, x):
-		ix = ((x.T-self.box[0])/(self.box[1]-self.box[0])*(np.array(self.y.shape[1:])-1)).T
+		ix = ((x.T-self.lo)*self.scale).T
 		return utils.interpol(self.y, ix, *self.args, **self.kwargs)
 
 class ip_linear(Interpolator):
@@ -86,19 +136,117 @@ class ip_linear(Interpolator):
 	def __init__(self, box, y, *args, **kwargs):
 		Interpolator.__init__(self, box, y, *args, **kwargs)
 		self.n, self.npre = self.box.shape[1], y.ndim-self.box.shape[1]
-		self.ys = lin_derivs_forward(y, self.npre)
+		self.set_derivs(lin_derivs_forward(y, self.npre))
+	def set_derivs(self, ys):
+		self.ys = np.ascontiguousarray(ys)
+		# Precompute the mapping from coordinates to cells
+		self.gshape = np.array(self.ys.shape[-self.n:])
+		self.imax   = (self.gshape-1)[:,None]
+		self.lo     = self.box[0]
+		self.scale  = self.gshape/(self.box[1]-self.box[0])
+	def refine(self, axis, y):
+		"""Like Interpolator.refine, but reuses the old derivative combinations
+		that don't involve the refined axis for the old samples, so that only
+		those involving the new samples or the refined axis are computed."""
+		y    = np.asfarray(y)
+		ax   = self.npre+axis
+		rest = [i for i in range(self.n) if i != axis]
+		# Combinations without a derivative along axis. The even samples are
+		# unchanged, the odd ones are new.
+		old  = self.ys[(slice(None),)*axis+(0,)]
+		val  = np.empty(old.shape[:self.n-1+ax]+(2*old.shape[self.n-1+ax],)+old.shape[self.n+ax:])
+		val[(slice(None),)*(self.n-1+ax)+(slice(0,None,2),)] = old
+		val[(slice(None),)*(self.n-1+ax)+(slice(1,None,2),)] = lin_derivs_axes(
+				y[(slice(None),)*ax+(slice(1,-1,2),)], self.npre, rest)
+		# Combinations with a derivative along axis must all be recomputed
+		der  = lin_derivs_axes(np.diff(y, axis=ax), self.npre, rest)
+		self.y = y
+		self.set_derivs(np.stack([val, der], axis))
 	def __call__(self, x):
 		flatx = x.reshape(x.shape[0],-1)
+		if numba is not None:
+			# Fast path: evaluate all the corners for each sample in a compiled loop
+			pshape = self.ys.shape[self.n:self.n+self.npre]
+			res = np.zeros((prod(pshape),flatx.shape[1]))
+			_ip_linear_eval(self.ys.reshape(2**self.n,res.shape[0],-1), self.lo, self.scale,
+					self.gshape, np.asfarray(flatx), res)
+			return res.reshape(pshape+x.shape[1:])
 		# Get the float cell index of each sample
-		px = ((flatx.T-self.box[0])/(self.box[1]-self.box[0])*(np.array(self.ys.shape[-self.n:]))).T
+		px = ((flatx.T-self.lo)*self.scale).T
 		ix = (np.floor(px)).astype(int)
-		ix = np.maximum(0,np.minimum(np.array(self.ys.shape[-self.n:])[:,None]-1,ix))
+		ix = np.maximum(0,np.minimum(self.imax,ix))
 		fx = px-ix
-		res = np.zeros(self.ys.shape[self.n:self.n+self.npre]+fx.shape[1:2])
-		for i in range(2**self.n):
-			I = np.unravel_index(i,(2,)*self.n)
-			res += self.ys[I][(slice(None),)*self.npre+tuple(ix)]*np.prod(fx**(np.array(I)[:,None]),0)
-		return res.reshape(res.shape[:-1]+x.shape[1:])
+		# The cell index is the same for all corners, so flatten it once and
+		# gather each corner with a single take
+		lin = np.ravel_multi_index(tuple(ix), self.gshape)
+		pshape = self.ys.shape[self.n:self.n+self.npre]
+		ys  = self.ys.reshape((2,)*self.n+(prod(pshape),-1))
+		# Sum over the corners with a loop specialized for this dimensionality
+		res = get_linear_eval(self.n)(ys, lin, fx)
+		return res.reshape(pshape+x.shape[1:])
+
+if numba is not None:
+	@numba.njit(parallel=True, fastmath=True)
+	def _ip_linear_eval(ys, lo, scale, shape_n, flatx, out):
+		"""Numba kernel for ip_linear. ys[2**n,npre,ngrid] are the flattened
+		forward derivatives, lo[n] the start of the bounding box, scale[n] the
+		number of cells per unit, shape_n[n] the number of cells in each
+		direction and flatx[n,nsamp] the sample positions. The result is
+		accumulated into out[npre,nsamp]."""
+		n, nsamp = flatx.shape
+		ncorner, npre = ys.shape[0], ys.shape[1]
+		# Work in blocks of samples, so the scratch array for the position
+		# inside the cell is allocated once per block rather than per sample
+		bsize  = 1024
+		nblock = (nsamp+bsize-1)//bsize
+		for b in numba.prange(nblock):
+			f = np.empty(n)
+			for p in range(b*bsize, min((b+1)*bsize, nsamp)):
+				ind = 0
+				for d in range(n):
+					u = (flatx[d,p]-lo[d])*scale[d]
+					i = min(max(int(np.floor(u)),0),shape_n[d]-1)
+					f[d] = u-i
+					ind  = ind*shape_n[d]+i
+				for c in range(ncorner):
+					# fx**0 = 1 and fx**1 = fx, so the weight is just the product
+					# of fx over the dimensions where this corner's bit is set
+					w = 1.0
+					for d in range(n):
+						if (c >> (n-1-d)) & 1: w *= f[d]
+					for k in range(npre):
+						out[k,p] += ys[c,k,ind]*w
+
+# Unrolled ip_linear corner sums, indexed by the number of dimensions
+linear_evals = {}
+
+def get_linear_eval(n):
+	"""Return a function eval(ys, lin, fx) computing the ip_linear sum over
+	the 2**n corners, with the corner loop unrolled. ys[(2,)*n+(npre,ngrid)]
+	are the flattened forward derivatives, lin[nsamp] the flat index of each
+	sample's cell and fx[n,nsamp] the position of each sample inside its cell. The weight
+	of a corner is the product of fx over the dimensions where its bit is set,
+	and is built from the weight of an earlier corner with one bit less.
+	The functions are generated on first use and cached."""
+	if n not in linear_evals:
+		lines = ["def eval(ys, lin, fx):"]
+		if n > 0: lines.append("\t%s, = fx" % ", ".join(["f%d" % d for d in range(n)]))
+		weights = {}
+		for c in range(2**n):
+			bits = tuple([(c >> (n-1-d)) & 1 for d in range(n)])
+			dims = [d for d in range(n) if bits[d]]
+			if len(dims) == 0: weights[c] = None
+			elif len(dims) == 1: weights[c] = "f%d" % dims[0]
+			else:
+				weights[c] = "w%d" % c
+				lines.append("\tw%d = %s*f%d" % (c, weights[c^(1<<(n-1-dims[-1]))], dims[-1]))
+			if c == 0: lines.append("\tres  = ys[%r].take(lin, -1)" % (bits,))
+			else:      lines.append("\tres += ys[%r].take(lin, -1)*%s" % (bits, weights[c]))
+		lines.append("\treturn res")
+		scope = {}
+		exec(compile("\n".join(lines)+"\n", "<ip_linear eval %d>" % n, "exec"), scope)
+		linear_evals[n] = scope["eval"]
+	return linear_evals[n]
 
 class ip_grad(Interpolator):
 	"""Gradient interpolation. Faster but less accurate than bilinear"""
@@ -106,11 +254,16 @@ class ip_grad(Interpolator):
 		Interpolator.__init__(self, box, y, *args, **kwargs)
 		self.n, self.npre = self.box.shape[1], y.ndim-self.box.shape[1]
 		self.ys  = lin_derivs_forward(y, self.npre)
+		# Precompute the mapping from coordinates to cells
+		gshape     = np.array(self.ys.shape[-self.n:])
+		self.imax  = (gshape-1)[:,None]
+		self.lo    = self.box[0]
+		self.scale = gshape/(self.box[1]-self.box[0])
 	def __call__(self, x):
 		flatx = x.reshape(x.shape[0],-1)
-		px = ((flatx.T-self.box[0])/(self.box[1]-self.box[0])*np.array(self.ys.shape[-self.n:])).T
+		px = ((flatx.T-self.lo)*self.scale).T
 		ix = (np.floor(px)).astype(int)
-		ix = np.maximum(0,np.minimum(np.array(self.ys.shape[-self.n:])[:,None]-1,ix))
+		ix = np.maximum(0,np.minimum(self.imax,ix))
 		fx = px-ix
 		res = np.zeros(self.ys.shape[self.n:self.n+self.npre]+fx.shape[1:2])
 		inds = np.concatenate([np.zeros(self.n,dtype=int)[None], np.eye(self.n,dtype=int)],0)
@@ -143,47 +296,58 @@ def lin_derivs_forward(y, npre=0):
 	it is one shorter in each direction along which the derivative is taken.
 	Derivatives are computed using forward difference."""
 	y        = np.asfarray(y)
-	nin      = y.ndim-npre
-	ys = np.zeros((2,)*nin+y.shape)
-	ys[(0,)*nin] = y
-	for i in range(nin):
-		whole,start,end = slice(None,None,None), slice(0,-1,None), slice(1,None,None)
-		target = (whole,)*(i)+(1,)+(0,)*(nin-i-1)
-		source = (whole,)*(i)+(0,)+(0,)*(nin-i-1)
-		cells1 = (whole,)*(npre+i)+(start,)+(whole,)*(nin-i-1)
-		cells2 = (whole,)*(npre+i)+(end,)  +(whole,)*(nin-i-1)
-		ys[target+cells1] = ys[source+cells2]-ys[source+cells1]
-	ys = ys[(slice(None),)*(nin+npre)+(slice(0,-1),)*nin]
+	return lin_derivs_axes(y, npre, range(y.ndim-npre))
+
+def lin_derivs_axes(y, npre, axes):
+	"""Like lin_derivs_forward, but only takes derivatives along the given
+	subset of the last dimensions, in increasing order. The other dimensions
+	are left at their full length, and get no leading (2,) axis."""
+	ys = y
+	for k, i in enumerate(axes):
+		# Split each existing combination into its value and its derivative
+		# along this axis. The k derivative axes already added come first.
+		ax = k+npre+i
+		ys = np.stack([ys[(slice(None),)*ax+(slice(0,-1),)], np.diff(ys, axis=ax)], k)
 	return ys
 
 def grad_forward(y, npre=0):
 	"""Given an array y with npre leading dimensions and n following dimensions,
-	the gradient along the n last dimensions, returning an array of shape (n,)+y.shape.
+	the gradient along the n last dimensions, returning an array of shape (n,)+y.shape,
+	except that it is one shorter along each of the last n dimensions.
 	Derivatives are computed using forward difference."""
 	y        = np.asfarray(y)
 	nin      = y.ndim-npre
-	dy       = np.zeros((nin,)+y.shape)
+	trim     = (slice(None),)*npre+(slice(0,-1),)*nin
+	dy       = []
 	for i in range(nin):
-		whole,start,end = slice(None,None,None), slice(0,-1,None), slice(1,None,None)
-		source = (whole,)*i+(0,)+(0,)*(nin-i-1)
-		cells1 = (whole,)*(npre+i)+(start,)+(whole,)*(nin-i-1)
-		cells2 = (whole,)*(npre+i)+(end,)  +(whole,)*(nin-i-1)
-		dy[i][cells1] = y[source+cells2]-y[source+cells1]
-	return dy[(slice(None),)+(slice(None,-1),)*(dy.ndim-1)]
+		ax = npre+i
+		dy.append(np.diff(y, axis=ax)[trim[:ax]+(slice(None),)+trim[ax+1:]])
+	return np.array(dy)
 
 def get_core(dtype):
 	if dtype == np.float32:   return fortran_32.fortran
 	elif dtype == np.float64: return fortran_64.fortran
 
-def spline_filter(data, order=3, border="cyclic", ndim=None, trans=False):
-	data = np.array(data)
+def spline_filter(data, order=3, border="cyclic", ndim=None, trans=False, copy=True):
+	"""Apply the spline prefilter of the given order along the first ndim
+	axes of data, returning the result. If copy is False, the filtering is
+	done in place when data is already a contiguous array."""
+	data = np.array(data) if copy else np.ascontiguousarray(data)
 	core = get_core(data.dtype)
 	iborder = {"zero":0, "nearest":1, "cyclic":2, "mirror":3}[border]
 	if ndim is None: ndim = data.ndim
-	for axis in range(ndim)[::-1 if trans else 1]:
-		core.spline_filter1d(data.reshape(-1), data.shape, axis, order, iborder, trans)
+	axes = np.arange(ndim)[::-1 if trans else 1]
+	core.spline_filter_nd(data.reshape(-1), data.shape, axes, order, iborder, trans)
 	return data
 
+def prod(x):
+	"""Product of a short sequence of integers, as a plain int."""
+	return int(reduce(operator.mul, x, 1))
+
+# Number of bytes of interpolation context per sample map_coordinates tries to
+# keep in cache at a time, by processing the {isub} dimensions in blocks.
+cache_size = 256*1024
+
 # idata[{dims},{isub}], points[ndim,{osub}], odata[{osub},{isub}]
 # This differs from scipy.map_coordinates, which has idata[{dims}], points[ndim,{osub}],
 # odata[{osub}]. But they are compatible when there are no isub dimensions.
@@ -224,7 +388,7 @@ def map_coordinates(idata, points, odata=None, mode="spline", order=3, border="c
 	For this to work, the odata argument must be specified.
 
 	Normally idata is read and odata is written to, but when trans=True,
-	idata is written to and odata is read from."""
+	idata is written to (in place) and odata is read from."""
 
 	imode   = {"conv":0, "spline":1, "lanczos":2}[mode]
 	iborder = {"zero":0, "nearest":1, "cyclic":2, "mirror":3}[border]
@@ -233,7 +397,15 @@ def map_coordinates(idata, points, odata=None, mode="spline", order=3, border="c
 	core    = get_core(idata.dtype)
 	ndim    = points.shape[0]
 	dpre,dpost= idata.shape[:ndim], idata.shape[ndim:]
-	def iprod(x): return np.product(x).astype(int)
+	npre, npost, npts = prod(dpre), prod(dpost), prod(points.shape[1:])
+	# The core wants pos[npts,ndim] in fortran order with the same type as
+	# idata. Get that with at most one copy, rather than one for the
+	# reshape and another for the type conversion in the wrapper.
+	pflat   = np.ascontiguousarray(points, dtype=idata.dtype).reshape(ndim,npts).T
+	# Process {isub} in blocks small enough that the interpolation context
+	# of each sample fits in cache
+	ncon    = core.get_weight_length(imode, order)**ndim
+	bsize   = max(1, cache_size//(idata.dtype.itemsize*(ncon+2)))
 	if not trans:
 		if odata is None:
 			if not deriv:
@@ -243,34 +415,18 @@ def map_coordinates(idata, points, odata=None, mode="spline", order=3, border="c
 				odata = np.empty(points.shape[1:]+(ndim,)+dpost,dtype=idata.dtype)
 		if mode == "spline" and prefilter:
 			idata = spline_filter(idata, order=order, border=border, ndim=ndim, trans=False)
-		if not deriv:
-			core.interpol(
-				idata.reshape(iprod(dpre),iprod(dpost)).T, dpre,
-				odata.reshape(iprod(points.shape[1:]),iprod(dpost)).T,
-				points.reshape(ndim, -1).T,
-				imode, order, iborder, False)
-		else:
-			core.interpol_deriv(
-				idata.reshape(iprod(dpre),iprod(dpost)).T, dpre,
-				odata.reshape(iprod(points.shape[1:]),ndim,iprod(dpost)).T,
-				points.reshape(ndim, -1).T,
-				imode, order, iborder, False)
-		return odata
+	# With trans, idata is the output. We cannot infer its shape from odata
+	# and points, so both idata and odata must be specified in that case.
+	iflat = idata.reshape(npre,npost).T
+	if not deriv:
+		core.interpol(iflat, dpre, odata.reshape(npts,npost).T, pflat,
+				imode, order, iborder, trans, bsize)
 	else:
-		# We cannot infer the shape of idata from odata and points. So both
-		# idata and odata must be specified in this case.
-		if not deriv:
-			core.interpol(
-				idata.reshape(iprod(dpre),iprod(dpost)).T, dpre,
-				odata.reshape(iprod(points.shape[1:]),iprod(dpost)).T,
-				points.reshape(ndim,-1).T,
-				imode, order, iborder, True)
-		else:
-			core.interpol_deriv(
-				idata.reshape(iprod(dpre),iprod(dpost)).T, dpre,
-				odata.reshape(iprod(points.shape[1:]),ndim,iprod(dpost)).T,
-				points.reshape(ndim,-1).T,
-				imode, order, iborder, True)
-		if mode == "spline" and prefilter:
-			idata[:] = spline_filter(idata, order=order, border=border, ndim=ndim, trans=True)
-		return idata
+		core.interpol_deriv(iflat, dpre, odata.reshape(npts,ndim,npost).T, pflat,
+				imode, order, iborder, trans)
+	if not trans:
+		return odata
+	if mode == "spline" and prefilter:
+		# idata is our output here, so it can be filtered in place
+		idata = spline_filter(idata, order=order, border=border, ndim=ndim, trans=True, copy=False)
+	return idata
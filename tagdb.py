@@ -3,8 +3,12 @@ with a set of ids, and then select ids based on those tags and values.
 For example query("deep56,night,ar2,in(bounds,Moon)") woult return a
 set of ids with the tags deep56, night and ar2, and where th Moon[2]
 array is in the polygon specified by the bounds [:,2] array."""
-import re, numpy as np, h5py, shlex, copy, warnings, time
+import re, ast, numpy as np, h5py, shlex, copy, warnings, time
 from enlib import utils
+try: import numexpr
+except ImportError: numexpr = None
+try: import ahocorasick
+except ImportError: ahocorasick = None
 
 class Tagdb:
 	def __init__(self, data=None, sort="id", default_fields=[], default_query=""):
@@ -12,8 +16,13 @@ class Tagdb:
 		data[name][...,nid], which must contain the field "id"."""
 		if data is None:
 			self.data = {"id":np.zeros(0,dtype='S5'),"subids":np.zeros(0,dtype='S5')}
+		elif isinstance(data, LazyDict):
+			# Lazy data is kept as is, so that columns are only read when needed
+			self.data = data
+			assert "id" in self.data, "Id field missing"
+			if self.data["id"].size == 0: self.data["id"] = np.zeros(0,dtype='S5')
 		else:
-			self.data = {key:np.array(val) for key,val in data.iteritems()}
+			self.data = {key:np.array(val) for key,val in data.items()}
 			assert "id" in self.data, "Id field missing"
 			if self.data["id"].size == 0: self.data["id"] = np.zeros(0,dtype='S5')
 		# Insert subids if missing
@@ -31,10 +40,97 @@ class Tagdb:
 		self.default_query = default_query
 		# Set our sorting field
 		self.sort  = sort
+		self.pack_bools()
+	def pack_bools(self):
+		"""Store the one-dimensional boolean fields as the rows of a single
+		array bool_block, with the fields in data being views into it. This
+		lets select extract all of them in one operation. Lazily read data
+		is left alone."""
+		self.bool_keys, self.bool_block, self.bool_bits = [], None, None
+		if not isinstance(self.data, LazyDict):
+			keys = sorted([key for key, val in self.data.items() if val.dtype == bool and val.ndim == 1])
+			if len(keys) > 0:
+				self.bool_keys  = keys
+				self.bool_block = np.array([self.data[key] for key in keys])
+				for i, key in enumerate(keys):
+					self.data[key] = self.bool_block[i]
+	def update_bits(self):
+		"""Build bool_bits, a bit-packed copy of bool_block that speeds up
+		queries that only combine tags. This is opt-in, since it is a
+		snapshot: call update_bits again after modifying packed fields in
+		place. pack_bools and select drop it."""
+		self.bool_bits = np.packbits(self.bool_block, axis=1) if self.bool_block is not None else None
+	def eval_tags(self, fields):
+		"""Evaluate the conjunction of the given query fields directly,
+		without going through eval. Each field must be the name of a
+		one-dimensional boolean field, optionally negated with ~. If all
+		of them are packed and update_bits has been called, bool_bits is
+		used, which processes 8 ids per byte. Returns None if the fields
+		are not of this form."""
+		if len(fields) == 0: return None
+		tags = []
+		for field in fields:
+			m = tag_expr.match(field)
+			if not m: return None
+			neg, key = m.groups()
+			if key not in self.data: return None
+			val = self.data[key]
+			if val.dtype != bool or val.ndim != 1: return None
+			tags.append((neg, key, val))
+		if self.bool_bits is not None and all([val.base is self.bool_block for neg, key, val in tags]):
+			bits = None
+			for neg, key, val in tags:
+				fbits = self.bool_bits[self.bool_keys.index(key)]
+				if neg: fbits = ~fbits
+				bits = fbits if bits is None else bits & fbits
+			return np.unpackbits(bits)[:self.bool_block.shape[1]].view(bool)
+		res = None
+		for neg, key, val in tags:
+			# Don't return a view of one of our fields
+			if neg: val = ~val
+			elif res is None: val = val.copy()
+			res = val if res is None else res & val
+		return res
 	def get_funcs(self):
 		return {"file_contains": file_contains}
 	def copy(self):
-		return copy.deepcopy(self)
+		res  = copy.deepcopy(self)
+		# The copy has the same ids, so it can share our id scanning state.
+		# The automaton is never modified after it has been built.
+		scan = getattr(self, "_id_scan", None)
+		if scan is not None and scan[0] is self.data["id"]:
+			res._id_scan = [res.data["id"]] + scan[1:]
+		return res
+	def __getstate__(self):
+		# Automatons can't be deep-copied. copy() handles the id scan instead.
+		state = self.__dict__.copy()
+		state.pop("_id_scan", None)
+		return state
+	def __setstate__(self, state):
+		# Copies don't share memory between bool_block and the fields
+		self.__dict__.update(state)
+		self.pack_bools()
+	def get_id_pattern(self, query):
+		"""Return a compiled regular expression matching those of our ids
+		that occur in query as bare words, or None if there are none."""
+		return make_id_pattern(self.find_ids(query))
+	def find_ids(self, query):
+		"""Return the set of our ids that occur in query. This is a plain
+		scan through the ids at first. Building an Aho-Corasick automaton
+		costs about as much as id_automaton_after such scans, so if
+		pyahocorasick is available, one is built once the same ids have
+		been scanned that many times, and used from then on."""
+		ids  = self.data["id"]
+		if len(ids) == 0: return set()
+		scan = getattr(self, "_id_scan", None)
+		if scan is None or scan[0] is not ids:
+			scan = self._id_scan = [ids, 0, None]
+		if scan[2] is None and ahocorasick is not None and scan[1] >= id_automaton_after:
+			scan[2] = make_id_automaton(ids)
+		if scan[2] is not None:
+			return set([w for end, w in scan[2].iter(query)])
+		scan[1] += 1
+		return set([id for id in ids if id in query])
 	@property
 	def ids(self):
 		return append_subs(self.data["id"], self.data["subids"])
@@ -47,11 +143,19 @@ class Tagdb:
 		ids, subids = split_ids(ids)
 		# Restrict to the subset of these ids
 		inds = utils.find(self.ids, ids)
-		odata = {key:val[...,inds] for key, val in self.data.iteritems()}
+		# Packed boolean fields are extracted all at once. Fields that have been
+		# replaced since they were packed are handled individually.
+		rows = [i for i, key in enumerate(self.bool_keys) if key in self.data and self.data[key].base is self.bool_block]
+		keys = [self.bool_keys[i] for i in rows]
+		odata = {key:val[...,inds] for key, val in self.data.items() if key not in keys}
+		block = self.bool_block[np.ix_(rows,inds)] if len(rows) > 0 else None
+		for i, key in enumerate(keys):
+			odata[key] = block[i]
 		# Update subids
-		odata["subids"] = np.array([merge_subid(a,b) for a, b in zip(odata["subids"], subids)])
+		odata["subids"] = merge_subids(odata["subids"], subids)
 		res = self.copy()
 		res.data = odata
+		res.bool_keys, res.bool_block, res.bool_bits = keys, block, None
 		return res
 	def query(self, query=None, apply_default_query=True):
 		"""Query the database. The query takes the form
@@ -66,9 +170,9 @@ class Tagdb:
 		# Hack: Support id fields as tags, even if they contain
 		# illegal characters..
 		t1 = time.time()
-		for id in self.data["id"]:
-			if id not in query: continue
-			query = re.sub(r"""(?<!['"])\b%s\b""" % id, "(id=='%s')" % id, query)
+		id_pattern = self.get_id_pattern(query)
+		if id_pattern is not None:
+			query = id_pattern.sub(lambda m: "(id=='%s')" % m.group(1), query)
 		# Split into ,-separated fields. Fields starting with a "+"
 		# are taken to be tag markers, and are simply propagated to the
 		# resulting ids.
@@ -109,13 +213,22 @@ class Tagdb:
 		# with low precedence for the comma stuff.
 		query = "(" + ")&(".join(fields) + ")"
 		subid = ",".join(subid)
-		# Evaluate the query. First build up the scope dict
-		scope = np.__dict__.copy()
-		scope.update(self.data)
-		# Extra functions
-		scope.update(self.get_funcs())
+		# Evaluate the query. Pure tag queries can use the packed bits.
+		# Otherwise only the fields the query actually refers to are looked
+		# up, so that lazily loaded fields we don't need are never read.
 		with utils.nowarn():
-			hits = eval(query, scope)
+			hits = self.eval_tags(fields)
+			if hits is None:
+				code  = compile_query(query)
+				fvals = {name: self.data[name] for name in code.co_names if name in self.data}
+				hits  = eval_numexpr(query, fvals)
+			if hits is None:
+				# Fall back on python. First build up the scope dict
+				scope = np.__dict__.copy()
+				scope.update(fvals)
+				# Extra functions
+				scope.update(self.get_funcs())
+				hits = eval(code, scope)
 		ids  = self.data["id"][hits]
 		subs = self.data["subids"][hits]
 		# Split the rest into a sorting field and a slice
@@ -136,7 +249,7 @@ class Tagdb:
 		ids = eval("ids"  + dsel)
 		subs= eval("subs" + dsel)
 		# Build our subid extensions and append them to ids
-		subs = np.array([merge_subid(subid, sub) for sub in subs])
+		subs = merge_subids(subid, subs)
 		ids = append_subs(ids, subs)
 		return ids
 	def __add__(self, other):
@@ -144,6 +257,7 @@ class Tagdb:
 		tag info from each."""
 		res = self.copy()
 		res.data = merge([self.data,other.data])
+		res.pack_bools()
 		return res
 	def write(self, fname, type=None):
 		write(fname, self, type=type)
@@ -169,12 +283,16 @@ class Tagdb:
 			datas.append(data)
 		return cls(merge(datas))
 	@classmethod
-	def read_hdf(cls, fname):
-		"""Read a Tagdb from an hdf file."""
-		data = {}
+	def read_hdf(cls, fname, lazy=False):
+		"""Read a Tagdb from an hdf file. If lazy is True, each field is
+		only read the first time it is used. The file then stays open
+		until all fields have been read, see LazyDict. Lazily read
+		Tagdbs don't pack their boolean fields."""
+		if lazy:
+			hfile = h5py.File(fname, "r")
+			return cls(LazyDict({key:hfile[key] for key in hfile}, hfile))
 		with h5py.File(fname, "r") as hfile:
-			for key in hfile:
-				data[key] = hfile[key].value
+			data = {key:hfile[key][()] for key in hfile}
 		return cls(data)
 	def write(self, fname, type=None):
 		"""Write a Tagdb in either the hdf or text format. This is
@@ -186,10 +304,51 @@ class Tagdb:
 		elif type == "hdf": return self.write_hdf(fname)
 		else: raise ValueError("Unknown Tagdb file type: %s" % fname)
 	def write_hdf(self, fname):
-		"""Write a Tagdb to an hdf file."""
+		"""Write a Tagdb to an hdf file. Fields are stored chunked and
+		compressed, which shrinks the padded string fields a lot."""
+		# Lazy data may come from the file we're about to overwrite
+		if isinstance(self.data, LazyDict): self.data.load()
 		with h5py.File(fname, "w") as hfile:
 			for key in self.data:
-				hfile[key] = self.data[key]
+				val = np.asarray(self.data[key])
+				# h5py can't chunk scalars or zero size arrays
+				if val.ndim == 0 or val.size == 0:
+					hfile[key] = val
+				elif val.dtype == bool:
+					hfile.create_dataset(key, data=val, chunks=True, compression="lzf", shuffle=True)
+				else:
+					hfile.create_dataset(key, data=val, chunks=True, compression="gzip",
+							compression_opts=4, shuffle=True)
+
+class LazyDict(dict):
+	"""A dict where some of the values are h5py datasets. These are read
+	into memory the first time they are accessed, and from then on
+	behave like normal values. Copies are normal dicts. The hdf file
+	the datasets belong to is kept open until load() is called."""
+	def __init__(self, data, hfile=None):
+		dict.__init__(self, data)
+		self.hfile = hfile
+	def load(self):
+		"""Read all remaining datasets into memory, and close the file."""
+		for key in self: self[key]
+		if self.hfile is not None: self.hfile.close()
+		self.hfile = None
+	def __getitem__(self, key):
+		val = dict.__getitem__(self, key)
+		if isinstance(val, h5py.Dataset):
+			val = val[()]
+			dict.__setitem__(self, key, val)
+		return val
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+	def iteritems(self):
+		for key in self: yield key, self[key]
+	def itervalues(self):
+		for key in self: yield self[key]
+	def items(self): return [(key, self[key]) for key in self]
+	def values(self): return [self[key] for key in self]
+	def copy(self): return dict(self.items())
+	def __reduce__(self): return (dict, (), None, None, iter(self.items()))
 
 # We want a way to build a dtype from file. Two main ways will be handy:
 # 1: The tag fileset.
@@ -201,11 +360,99 @@ class Tagdb:
 
 def read(fname, type=None): return Tagdb.read(fname, type=type)
 def read_txt(fname): return Tagdb.read_txt(fname)
-def read_hdf(fname): return Tagdb.read_hdf(fname)
+def read_hdf(fname, lazy=False): return Tagdb.read_hdf(fname, lazy=lazy)
 
 def write(fname, tagdb, type=None): return tagdb.write(fname, type=type)
 def write_hdf(fname, tagdb): return tagdb.write(fname)
 
+# Query fields consisting of a single, possibly negated, tag
+tag_expr = re.compile(r"^\s*(~?)\s*([A-Za-z_]\w*)\s*$")
+
+# Compiled id patterns, indexed by the sorted tuple of ids they match
+id_pattern_cache = {}
+id_pattern_cache_size = 1024
+
+def make_id_pattern(words):
+	"""Build a regular expression matching any of the given ids as a bare,
+	unquoted word, or None if there are no ids. Patterns are cached."""
+	if len(words) == 0: return None
+	# Longest first, so ids that are prefixes of other ids don't shadow them
+	words = tuple(sorted(words, key=lambda w: (-len(w), w)))
+	try: return id_pattern_cache[words]
+	except KeyError:
+		if len(id_pattern_cache) >= id_pattern_cache_size: id_pattern_cache.clear()
+		pattern = re.compile(r"""(?<!['"])\b(%s)\b""" % "|".join([re.escape(w) for w in words]))
+		id_pattern_cache[words] = pattern
+		return pattern
+
+# Number of plain id scans after which find_ids switches to an automaton
+id_automaton_after = 100
+
+def make_id_automaton(ids):
+	"""Build an Aho-Corasick automaton finding all occurences of the
+	given ids in a string."""
+	automaton = ahocorasick.Automaton()
+	for id in set(ids): automaton.add_word(id, id)
+	automaton.make_automaton()
+	return automaton
+
+# Compiled query expressions, indexed by the expression string
+query_cache = {}
+query_cache_size = 1024
+
+def compile_query(expr):
+	"""Compile the python expression expr for evaluation with eval,
+	reusing the result if the same expression was seen before."""
+	try: return query_cache[expr]
+	except KeyError:
+		if len(query_cache) >= query_cache_size: query_cache.clear()
+		code = compile(expr, "<query>", "eval")
+		query_cache[expr] = code
+		return code
+
+# Queries numexpr could not handle, so we don't retry them. Limited to
+# query_cache_size entries like query_cache.
+numexpr_failed = set()
+
+def eval_numexpr(expr, fields):
+	"""Evaluate the query expression expr using numexpr, with the
+	variables given by the dict fields. numexpr caches the compiled
+	expression itself, and evaluates it blockwise without full size
+	temporaries. Returns None if numexpr isn't available or doesn't
+	support the expression, for example because it uses indexing or
+	other functions, or because numexpr would give a different result,
+	in which case it should be evaluated with eval."""
+	if numexpr is None or expr in numexpr_failed: return None
+	if not numexpr_compatible(expr, fields): return None
+	try:
+		return numexpr.evaluate(expr, local_dict=fields, global_dict={})
+	except Exception:
+		if len(numexpr_failed) >= query_cache_size: numexpr_failed.clear()
+		numexpr_failed.add(expr)
+		return None
+
+# numexpr only gets queries where it is known to agree with eval. It
+# compares float32 fields with double precision literals, and its integer
+# / and % truncate towards zero instead of flooring, which matters for the
+# -1 placeholders merge inserts. So only comparisons and logical operations
+# on bool, int64 and float64 fields and numeric literals are allowed.
+numexpr_dtypes = set([np.dtype(bool), np.dtype(np.int64), np.dtype(np.float64)])
+numexpr_nodes  = (ast.Expression, ast.Load, ast.Name, ast.Num, ast.Compare, ast.BinOp,
+		ast.UnaryOp, ast.BitAnd, ast.BitOr, ast.Invert, ast.USub, ast.Eq, ast.NotEq,
+		ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+def numexpr_compatible(expr, fields):
+	"""Return True if numexpr evaluates the query expression expr with the
+	variables given by the dict fields exactly like eval would."""
+	try: tree = ast.parse(expr, mode="eval")
+	except SyntaxError: return False
+	for node in ast.walk(tree):
+		if not isinstance(node, numexpr_nodes): return False
+		if isinstance(node, ast.Name):
+			if node.id not in fields: return False
+			if np.asarray(fields[node.id]).dtype not in numexpr_dtypes: return False
+	return True
+
 def merge(tagdatas):
 	"""Merge two or more tagdbs into a total one, which will have the
 	union of the ids."""
@@ -218,7 +465,7 @@ def merge(tagdatas):
 	nid  = len(tot_ids)
 	data_tot = {}
 	for di, data in enumerate(tagdatas):
-		for key, val in data.iteritems():
+		for key, val in data.items():
 			if key not in data_tot:
 				# Hard to find an appropriate default value for
 				# all types. We use false for bool to let tags
@@ -259,30 +506,31 @@ def parse_tagfile_top(fname):
 				res.append((toks[0].format(**vars), set(toks[1:])))
 	return res
 
+def read_idlist(fname):
+	"""Returns the first word of each line in fname as a list,
+	skipping empty lines and comments (#). The file is read in one go
+	rather than line by line."""
+	with open(fname,"r") as f:
+		words = [line.split(None,1) for line in f.read().splitlines() if not line.startswith("#")]
+	return [w[0] for w in words if w]
+
 def parse_tagfile_idlist(fname):
 	"""Reads a file containing an id per line, and returns the ids as a list."""
-	res = []
-	with open(fname,"r") as f:
-		for line in f:
-			line = line.rstrip()
-			if len(line) < 1 or line[0] == "#": continue
-			res.append(line.split()[0])
-	return res
+	return read_idlist(fname)
 
 def file_contains(fname, ids):
-	lines = [line.split()[0] for line in open(fname,"r") if not line.startswith("#")]
-	return utils.contains(ids, lines)
+	return np.in1d(ids, read_idlist(fname))
 
 def load_ids(fname):
-	lines = [line.split()[0] for line in open(fname,"r") if not line.startswith("#")]
-	return np.array(lines)
+	return np.array(read_idlist(fname))
 
 def split_ids(ids):
-	bids, subids = [], []
-	for id in ids:
-		toks = id.split(":")
-		bids.append(toks[0])
-		subids.append(toks[1] if len(toks) > 1 else "")
+	"""Split ids of the form id:subid into arrays of ids and subids.
+	The subid is empty for ids without a ":"."""
+	ids = np.asarray(ids, dtype=str)
+	if ids.size == 0: return ids, ids
+	bids, _, rest = np.rollaxis(np.char.partition(ids, ":"),-1)
+	subids = np.char.partition(rest, ":")[...,0]
 	return bids, subids
 
 def merge_subid(a, b):
@@ -291,6 +539,24 @@ def merge_subid(a, b):
 	except: pass
 	return ",".join(sorted(list(res)))
 
+def merge_subids(a, b):
+	"""Vectorized version of merge_subid for arrays of subids a and b.
+	The common cases where at most one distinct single-entry subid is
+	involved are handled directly, and only the rest fall back on
+	merge_subid."""
+	a, b    = np.broadcast_arrays(np.asarray(a, dtype=str), np.asarray(b, dtype=str))
+	empty_a = np.char.str_len(a) == 0
+	empty_b = np.char.str_len(b) == 0
+	single  = (np.char.find(a, ",") < 0) & (np.char.find(b, ",") < 0)
+	easy    = single & (empty_a | empty_b | (a == b))
+	res     = np.where(empty_a, b, a)
+	hard    = np.where(~easy)[0]
+	if len(hard) > 0:
+		vals = np.array([merge_subid(x,y) for x,y in zip(a[hard],b[hard])])
+		res  = res.astype(np.result_type(res, vals))
+		res[hard] = vals
+	return res
+
 def append_subs(ids, subs):
 	if len(ids) == 0: return ids
 	sep_helper = np.array(["",":"])
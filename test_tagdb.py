@@ -0,0 +1,99 @@
+import numpy as np, os, shutil, tempfile
+from enlib import tagdb
+
+def make_db():
+	n = 50
+	data = {
+		"id":    np.array(["%d.%d.ar%d" % (1000+i, 2000+i, i%3+1) for i in range(n)]),
+		"night": np.arange(n)%2 == 0,
+		"deep":  np.arange(n)%3 == 0,
+		"pwv":   np.linspace(0, 3, n),
+	}
+	return tagdb.Tagdb(data)
+
+def check_equal(a, b):
+	assert sorted(a.data.keys()) == sorted(b.data.keys())
+	for key in a.data:
+		assert np.array_equal(a.data[key], b.data[key]), key
+
+def with_tmpdir(func):
+	def wrapper():
+		dir = tempfile.mkdtemp()
+		try: func(dir)
+		finally: shutil.rmtree(dir)
+	wrapper.__name__ = func.__name__
+	return wrapper
+
+@with_tmpdir
+def test_hdf_roundtrip(dir):
+	fname = os.path.join(dir, "db.hdf")
+	db = make_db()
+	db.write(fname)
+	db2 = tagdb.Tagdb.read(fname)
+	# Writing back to the file we read from must work
+	db2.write(fname)
+	db3 = tagdb.Tagdb.read(fname)
+	check_equal(db, db3)
+	assert db3.bool_keys == ["deep", "night"]
+	assert np.array_equal(db3.query("night,deep,/all"), db.query("night,deep,/all"))
+
+@with_tmpdir
+def test_hdf_lazy_roundtrip(dir):
+	fname = os.path.join(dir, "db.hdf")
+	db = make_db()
+	db.write(fname)
+	db2 = tagdb.read_hdf(fname, lazy=True)
+	assert np.array_equal(db2.query("night,/all"), db.query("night,/all"))
+	db2.write(fname)
+	check_equal(db, tagdb.read_hdf(fname))
+
+@with_tmpdir
+def test_hdf_lazy_data_outlives_tagdb(dir):
+	fname = os.path.join(dir, "db.hdf")
+	db = make_db()
+	db.write(fname)
+	data = tagdb.read_hdf(fname, lazy=True).data
+	assert np.array_equal(data["pwv"], db.data["pwv"])
+
+def test_packed_tags_in_place():
+	db = make_db()
+	ids = db.data["id"]
+	# Packed fields can be modified in place, and tag queries see it
+	db.data["night"][:] = False
+	assert len(db.query("night,/all")) == 0
+	db.data["night"][:5] = True
+	assert list(db.query("night,/all")) == list(ids[:5])
+	# The bit-packed path is a snapshot, and must be refreshed explicitly
+	db.update_bits()
+	assert list(db.query("night,~deep,/all")) == [id for id in ids[:5] if id not in ids[::3]]
+	db.data["night"][:] = True
+	db.update_bits()
+	assert len(db.query("night,/all")) == len(ids)
+	sel = db.select(ids[:10])
+	sel.data["deep"][:] = False
+	assert len(sel.query("deep,/all")) == 0
+
+def test_numexpr_matches_eval():
+	data = {
+		"id":  np.array(["a1","a2","a3","a4"]),
+		"pwv": np.array([0.1,0.2,0.05,0.3], np.float32),
+		"alt": np.array([0.1,0.2,0.05,0.3]),
+		"k":   np.array([-1,-7,4,2]),
+		"ok":  np.array([True,False,True,True]),
+	}
+	queries = ["pwv>0.1", "k%3==2", "k/2==-4", "alt>0.1", "(k>0)|~ok", "alt*2>0.3", "k>=-1,ok"]
+	def run():
+		db = tagdb.Tagdb(data)
+		return [list(db.query(q+",/all")) for q in queries]
+	numexpr = tagdb.numexpr
+	tagdb.numexpr = None
+	try: ref = run()
+	finally: tagdb.numexpr = numexpr
+	assert run() == ref
+	assert ref[:3] == [["a2","a4"], ["a1","a2","a4"], ["a2"]]
+	if numexpr is not None:
+		# Simple comparisons on safe types should still use numexpr
+		fields = {"alt":data["alt"], "k":data["k"], "ok":data["ok"]}
+		assert tagdb.eval_numexpr("(alt>0.1)&(k>=-1)&~ok", fields) is not None
+		assert tagdb.eval_numexpr("(pwv>0.1)", {"pwv":data["pwv"]}) is None
+		assert tagdb.eval_numexpr("(k%3==2)", fields) is None